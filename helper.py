@@ -1,3 +1,6 @@
+from collections import defaultdict
+import functools
+import heapq
 import json
 import os
 import math
@@ -11,7 +14,16 @@ import numpy
 from scipy.spatial.distance import cosine
 from sklearn.metrics import mean_absolute_error
 from sklearn.model_selection import KFold
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    from sklearn.externals.joblib import Parallel, delayed
 import yaml
+# The C loader is only available when PyYAML is built with libyaml.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 
 
@@ -19,16 +31,19 @@ import yaml
 #   Configuration helpers
 ###
 
+@functools.lru_cache(maxsize=None)
 def __read_config():
     '''Reads the config.yml file and returns the Yaml config file as a
-    dictionary.
+    dictionary. The file is only read once and the parsed dictionary is
+    cached for all subsequent calls.
 
     Void -> dict
     '''
 
     with open(os.path.abspath(os.path.join(__root_path(), 'config.yml')), 'r') as fp:
-        return yaml.load(fp.read())
+        return yaml.load(fp, Loader=SafeLoader)
 
+@functools.lru_cache(maxsize=None)
 def __root_path():
     '''Returns the project directories path.
 
@@ -74,7 +89,7 @@ def max_length(texts):
             max_token_length = len(tokens)
     return max_token_length
 
-def process_data(texts, wordvec_model, max_token_length):
+def process_data(texts, wordvec_model, max_token_length, dtype=numpy.float32):
     '''Given a list of Strings a word2vec model and the maximum token length
     it will return a 3 dimensional numpy array of the following shape:
     (number of texts, word2vec model vector size, max token length).
@@ -84,24 +99,47 @@ def process_data(texts, wordvec_model, max_token_length):
     The vector of zero applices when the text has no more tokens but has not
     reached the mex token length (This is also called padding).
 
+    The array is float32 by default, the same as the word2vec vectors, this can
+    be changed through dtype e.g. numpy.float16 to halve the memory again.
+
     List of strings, gensim.models.Word2Vec, Integer -> 3D Numpy array.
     '''
 
-    vector_length = wordvec_model.vector_size
-    all_vectors = []
+    return texts_to_tensor(texts, wordvec_model, max_token_length, dtype=dtype)
 
-    for text in texts:
-        vector_format = []
-        tokens = unitok_tokens(text)[0:max_token_length]
-        for token in tokens:
-            if token in wordvec_model.vocab:
-                vector_format.append(wordvec_model[token].reshape(1,vector_length))
-            else:
-                vector_format.append(numpy.zeros(300).reshape(1,vector_length))
-        while len(vector_format) != max_token_length:
-            vector_format.append(numpy.zeros(vector_length).reshape(1,vector_length))
-        all_vectors.append(numpy.vstack(vector_format))
-    return numpy.asarray(all_vectors)
+def texts_to_tensor(texts, wordvec_model, max_token_length=None,
+                    dtype=numpy.float32):
+    '''Same as process_data but the texts are only tokenised once and the
+    max token length is optional. If max_token_length is None it is
+    calculated from the tokenised texts, as max_length would, so the length
+    of the longest text is the second dimension of the returned array.
+
+    List of strings, gensim.models.Word2Vec, Integer or None -> 3D Numpy array.
+    '''
+
+    all_tokens = [unitok_tokens(text) for text in texts]
+    if max_token_length is None:
+        max_token_length = max((len(tokens) for tokens in all_tokens), default=0)
+
+    vector_length = wordvec_model.vector_size
+    vocab = wordvec_model.vocab
+    all_vectors = numpy.zeros((len(texts), max_token_length, vector_length),
+                              dtype=dtype)
+
+    # Positions (text, token) of all in vocabulary tokens and their index in
+    # the word2vec matrix so that all vectors can be copied in one go.
+    text_indexs = []
+    token_indexs = []
+    vocab_indexs = []
+    for text_index, tokens in enumerate(all_tokens):
+        for token_index, token in enumerate(tokens[0:max_token_length]):
+            vocab_entry = vocab.get(token)
+            if vocab_entry is not None:
+                text_indexs.append(text_index)
+                token_indexs.append(token_index)
+                vocab_indexs.append(vocab_entry.index)
+    all_vectors[text_indexs, token_indexs] = wordvec_model.syn0[vocab_indexs]
+    return all_vectors
 
 
 ###
@@ -116,8 +154,20 @@ def unitok_tokens(text):
     String -> List of Strings
     '''
 
+    return list(__unitok_tokens(text))
+
+@functools.lru_cache(maxsize=None)
+def __unitok_tokens(text):
+    '''Cached version of unitok_tokens so that texts that are tokenised more
+    than once e.g. max_length followed by process_data or across cross
+    validation folds are only tokenised once. Returns a tuple so that the
+    cached value can not be modified by the caller.
+
+    String -> Tuple of Strings
+    '''
+
     tokens = tok.tokenize(text, unitok.configs.english)
-    return [token for tag, token in tokens if token.strip()]
+    return tuple(token for tag, token in tokens if token.strip())
 
 def whitespace_tokens(text):
 
@@ -139,23 +189,18 @@ def ngrams(token_list, n_range):
     concatenated with the n closests tokens.'''
 
     def get_n_grams(temp_tokens, n):
-        token_copy = list(temp_tokens)
-        gram_tokens = []
-        while(len(token_copy) >= n):
-            n_list = []
-            for i in range(0,n):
-                n_list.append(token_copy[i])
-            token_copy.pop(0)
-            gram_tokens.append(' '.join(n_list))
-        return gram_tokens
+        # Zips n offset views of the tokens so each tuple is one n-gram.
+        return [' '.join(gram) for gram in
+                zip(*(temp_tokens[i:] for i in range(n)))]
 
     all_n_grams = []
     for tokens in token_list:
         if n_range == (1,1):
             all_n_grams.append(tokens)
         else:
-            all_tokens = []
-            for n in range(n_range[0], n_range[1] + 1):
+            # 1-grams are the tokens themselves so they do not need building.
+            all_tokens = list(tokens) if n_range[0] == 1 else []
+            for n in range(max(n_range[0], 2), n_range[1] + 1):
                 all_tokens.extend(get_n_grams(tokens, n))
             all_n_grams.append(all_tokens)
 
@@ -165,17 +210,41 @@ def ngrams(token_list, n_range):
 # Comparison helper to compare predicted values with those submitted
 ###
 
+def __normalise(vectors):
+    '''Given a 1D or 2D numpy array returns the array where the vector (or
+    each row vector) has been divided by its length (L2 norm).
+
+    numpy array -> numpy array
+    '''
+
+    return vectors / numpy.linalg.norm(vectors, axis=-1, keepdims=True)
+
+@functools.lru_cache(maxsize=1)
 def __get_submitted_values():
+    '''Returns the names of the submissions made to SEMEval and a 2D numpy array
+    where each row is the sentiment values of that submission normalised to
+    unit length. The submission files are only read once and the result is
+    cached.
+
+    Void -> tuple(tuple of Strings, 2D float32 numpy array)
+    '''
+
     early_stop_path = ('Early Stopping',
                        config_path(['submitted_data', 'early_stopping']))
     tweeked_path = ('Tweeked', config_path(['submitted_data', 'tweeked']))
 
+    sub_names = []
+    all_sentiment_values = []
     for sub_name, sub_path in [early_stop_path, tweeked_path]:
-        sentiment_values = []
         with open(sub_path, 'r') as fp:
-            for data in json.load(fp):
-                sentiment_values.append(data['sentiment score'])
-        yield sub_name, sentiment_values
+            sentiment_values = [data['sentiment score'] for data in json.load(fp)]
+        sub_names.append(sub_name)
+        all_sentiment_values.append(sentiment_values)
+    all_sentiment_values = __normalise(numpy.asarray(all_sentiment_values,
+                                                     dtype=numpy.float32))
+    # Cached so it should not be changed by the caller.
+    all_sentiment_values.flags.writeable = False
+    return tuple(sub_names), all_sentiment_values
 
 def compare(predicted_sentiments):
     '''Given a list or numpy array will return 1 - cosine simlarity between
@@ -186,8 +255,10 @@ def compare(predicted_sentiments):
     are to those submitted to SEMEval.
     '''
 
-    for sub_name, sent_values in __get_submitted_values():
-        sim_value = 1 - cosine(sent_values, predicted_sentiments)
+    sub_names, sub_values = __get_submitted_values()
+    # Both are unit length so the dot product is the cosine similarity.
+    sim_values = sub_values.dot(__normalise(numpy.ravel(predicted_sentiments)))
+    for sub_name, sim_value in zip(sub_names, sim_values):
         msg = ('Similarity between your predicted values and {}: {}'
               ).format(sub_name, sim_value)
         print(msg)
@@ -267,7 +338,15 @@ def fin_data(data_type, test_data=False):
             return __text_company(json.load(fp))
         return __text_sentiment_company(json.load(fp))
 
+@functools.lru_cache(maxsize=1)
 def fin_word_vector():
+    '''Returns the finance word2vec model stored at the models fin_word2vec path
+    in the config file. The model is only loaded from disk once, every call
+    returns the same model. To free the model's memory use
+    fin_word_vector.cache_clear().
+
+    Void -> gensim.models.Word2Vec
+    '''
 
     fin_word2vec_path = config_path(['models', 'fin_word2vec'])
     return gensim.models.Word2Vec.load(fin_word2vec_path)
@@ -316,19 +395,53 @@ def stats_report(clf, f_name):
             fp.write("{}\t{}\t{}\n".format(str(mean), str(std), '\t'.join(param_values)))
 
 def pred_true_diff(pred_values, true_values, score_function, mapping=None):
-    results = []
+    '''Given the predicted and true values returns a list of tuples of
+    (index, predicted value, score) where score is the score_function applied
+    to that single predicted and true value. The index is either the position
+    of the value or the value at that position within mapping.
 
+    When score_function is mean_absolute_error the scores are computed all at
+    once as the absolute error of each value.
+
+    list, list, function, list -> list of tuples (index, predicted value, score)
+    '''
+
+    indexs = range(len(pred_values))
+    # This is to support both lists and numpy arrays
+    if hasattr(mapping,'__index__') or hasattr(mapping, 'index'):
+        indexs = mapping
+
+    if score_function is mean_absolute_error:
+        scores = numpy.abs(numpy.ravel(pred_values) - numpy.ravel(true_values))
+        return list(zip(indexs, pred_values, scores.tolist()))
+
+    results = []
     for i in range(len(pred_values)):
-        mapped_value = i
-        # This is to support both lists and numpy arrays
-        if hasattr(mapping,'__index__') or hasattr(mapping, 'index'):
-            mapped_value = mapping[i]
-        results.append((mapped_value, pred_values[i],
+        results.append((indexs[i], pred_values[i],
                        score_function([pred_values[i]], [true_values[i]])))
     return results
 
+def __fold_errors(train_data, train_values_array, model, train, test,
+                  score_function):
+    '''Fits the model on the train indexs of the data and returns the
+    pred_true_diff output of the models predictions on the test indexs. A
+    single fold of error_cross_validate.
+
+    list, numpy array, model, numpy array, numpy array, function ->
+    list of tuples (index, predicted value, score)
+    '''
+
+    model.fit([train_data[i] for i in train], train_values_array[train])
+
+    predicted_values = model.predict([train_data[i] for i in test])
+    real_values = train_values_array[test]
+
+    return pred_true_diff(predicted_values, real_values, score_function,
+                          mapping=test)
+
 def error_cross_validate(train_data, train_values, model, n_folds=10,
-                         shuffle=True, score_function=mean_absolute_error):
+                         shuffle=True, score_function=mean_absolute_error,
+                         n_jobs=1):
     '''Given the training data and true values for that data both a list and
     a model that trains off that data using a fit method it will n_fold
     cross validate off that data and use the models predict function to predict
@@ -336,24 +449,23 @@ def error_cross_validate(train_data, train_values, model, n_folds=10,
     default Mean Absolute Error. The returned value is a list of tuples the first
     value being the index to the data that second value score reprsents.
 
+    n_jobs is the number of folds to run in parallel, -1 uses all CPUs. When
+    more than one job is used each process fits its own copy of the model
+    therefore the model has to be picklable and the model given is not fitted.
+
     returned list of tuples (index, score)
     '''
 
-    results = []
-
-    train_data_array = numpy.asarray(train_data)
     train_values_array = numpy.asarray(train_values)
 
     kfold = KFold(n_splits=n_folds, shuffle=shuffle)
-    for train, test in kfold.split(train_data_array, train_values_array):
-        model.fit(train_data_array[train], train_values_array[train])
-
-        predicted_values = model.predict(train_data_array[test])
-        real_values = train_values_array[test]
-
-        results.extend(pred_true_diff(predicted_values, real_values,
-                                      score_function, mapping=test))
-    return results
+    # The folds are indexs into train_data so that train_data does not have to
+    # be converted into a numpy object array.
+    fold_results = Parallel(n_jobs=n_jobs)(
+        delayed(__fold_errors)(train_data, train_values_array, model, train,
+                               test, score_function)
+        for train, test in kfold.split(range(len(train_data))))
+    return [result for fold_result in fold_results for result in fold_result]
 
 
 def top_n_errors(error_res, train_data, train_values, companies, n=10):
@@ -366,8 +478,7 @@ def top_n_errors(error_res, train_data, train_values, companies, n=10):
     Return sub list of data.
     '''
 
-    error_res = sorted(error_res, key=lambda value: value[2], reverse=True)
-    top_errors = error_res[:n]
+    top_errors = heapq.nlargest(n, error_res, key=lambda value: value[2])
     return [{'Sentence':train_data[index], 'Company':companies[index],
             'True value':train_values[index], 'Pred value':pred_value,
             'index':index} for index, pred_value, _ in top_errors]
@@ -384,42 +495,43 @@ def comps2sent(text_data, companies):
     list of strings, list of strings -> dictionary
     '''
 
-    sentence_compid = {}
-    for i in range(len(text_data)):
-        text = text_data[i]
-        comp = companies[i]
-        comps_indexs = sentence_compid.get(text, [])
-        comps_indexs.append((comp,i))
-        sentence_compid[text] = comps_indexs
-    compscount_ids = {}
-    for _, compsid in sentence_compid.items():
-        ids = compscount_ids.get(len(compsid), [])
-        ids.append([comp_id[1] for comp_id in compsid])
-        compscount_ids[len(compsid)] = ids
-    return compscount_ids
-
-def sent_type_errors(top_errors, compscount_ids):
-    '''Given the top  N errors and the number of companies to ids it will return
-    the top N errors sorted in a dictionary as the number of companies in the
-    sentences and within that the errors. Returns dict.
+    sentence_compid = defaultdict(list)
+    for i, (text, comp) in enumerate(zip(text_data, companies)):
+        sentence_compid[text].append((comp,i))
+    compscount_ids = defaultdict(list)
+    for compsid in sentence_compid.values():
+        compscount_ids[len(compsid)].append([comp_id[1] for comp_id in compsid])
+    return dict(compscount_ids)
+
+@functools.lru_cache(maxsize=None)
+def __ids_compscount(text_data, companies):
+    '''Given the text data and companies as tuples returns a dictionary of the
+    index of each text to the number of companies mentioned in that text using
+    comps2sent. Cached so that repeated error analysis over the same data
+    only builds the index once. Tuples are required so that they can be
+    cached.
+
+    tuple of strings, tuple of strings -> dict
+    '''
+
+    compscount_ids = comps2sent(text_data, companies)
+    return {a_id : compscount
+            for compscount, ids_list in compscount_ids.items()
+            for ids in ids_list for a_id in ids}
+
+def sent_type_errors(top_errors, ids_compscount):
+    '''Given the top  N errors and a dictionary of the text index to the number
+    of companies in that text it will return the top N errors sorted in a
+    dictionary as the number of companies in the sentences and within that the
+    errors. Returns dict.
 
     List, dict -> dict
     '''
 
-    ids_compscount = {}
-    for compscount, ids_list in compscount_ids.items():
-        for ids in ids_list:
-            for a_id in ids:
-                ids_compscount[a_id] = compscount
-
-    comps_errors = {}
+    comps_errors = defaultdict(list)
     for error in top_errors:
-        sent_id = error['index']
-        comp_count = ids_compscount[sent_id]
-        errors = comps_errors.get(comp_count, [])
-        errors.append(error)
-        comps_errors[comp_count] = errors
-    return comps_errors
+        comps_errors[ids_compscount[error['index']]].append(error)
+    return dict(comps_errors)
 
 def error_dist(comps_ids):
     return {k : len(v) for k, v in comps_ids.items()}
@@ -442,11 +554,10 @@ def error_analysis(data, values, comps, clf, text=False, cv=None, num_errors=50,
     returns tuple of dict, dict
     '''
 
-    compcount_id = None
     if text:
-        compcount_id = comps2sent(text, comps)
+        ids_compscount = __ids_compscount(tuple(text), tuple(comps))
     else:
-        compcount_id = comps2sent(data, comps)
+        ids_compscount = __ids_compscount(tuple(data), tuple(comps))
     error_results = None
     if cv:
         if isinstance(cv, dict):
@@ -460,7 +571,7 @@ def error_analysis(data, values, comps, clf, text=False, cv=None, num_errors=50,
         error_results = pred_true_diff(pred_values, values, score_function)
     top_errors = top_n_errors(error_results, data, values,
                               comps, n=num_errors)
-    error_details = sent_type_errors(top_errors, compcount_id)
+    error_details = sent_type_errors(top_errors, ids_compscount)
     error_distribution = error_dist(error_details)
     return error_details, error_distribution
 
@@ -47,11 +47,10 @@ class EarlyStoppingLSTM(LSTMModel):
 
         super().fit()
 
-        max_length    = self._set_max_length(train_texts)
+        train_vectors = self._fit_text2vector(train_texts)
+        max_length    = self._max_length
         vector_length = self._word2vec_model.vector_size
 
-        train_vectors = self._text2vector(train_texts)
-
         model = Sequential()
         model.add(Dropout(0.5, input_shape=(max_length, vector_length)))
         # Output of this layer is of max_length by max_length * 2 dimension
@@ -64,10 +64,20 @@ class LSTMModel:
             raise Exception('Your model requires training first')
         return self._model.predict(test_vectors)
 
-    def _set_max_length(self, texts):
+    def _fit_text2vector(self, texts):
+        '''Given a list of Strings will convert them to a numpy 3D array, the
+        same as self._text2vector, and set self._max_length to the length of the
+        longest text. The texts are only tokenised once.
 
-        self._max_length = helper.max_length(texts)
-        return self._max_length
+        see semeval.helper.texts_to_tensor for more details.
+
+        list of strings -> 3D numpy array (len(texts), max_number_tokens,
+        self.word2vec_model.vector_size)
+        '''
+
+        vectors = helper.texts_to_tensor(texts, self._word2vec_model)
+        self._max_length = vectors.shape[1]
+        return vectors
 
     def _set_model(self, model):
 
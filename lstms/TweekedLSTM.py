@@ -49,11 +49,10 @@ class TweekedLSTM(LSTMModel):
         super().fit()
 
         # Required for any transformation of text latter.
-        max_length    = self._set_max_length(train_texts)
+        train_vectors = self._fit_text2vector(train_texts)
+        max_length    = self._max_length
         vector_length = self._word2vec_model.vector_size
 
-        train_vectors = self._text2vector(train_texts)
-
         model = Sequential()
         # Output of this layer is of max_length by max_length * 2 dimension
         # instead of max_length, vector_length